@@ -1,6 +1,21 @@
-from typing import List, Optional 
-
-from sqlmodel import Field, Relationship, Session, SQLModel, create_engine, or_, select
+import sys
+from typing import Any, Iterable, List, Mapping, Optional 
+
+from sqlalchemy import lambda_stmt
+from sqlalchemy.orm import contains_eager, defer, selectinload
+from sqlmodel import (
+    Field,
+    Relationship,
+    Session,
+    SQLModel,
+    func,
+    insert,
+    select,
+    union_all,
+    update,
+)
+
+from db import SessionLocal, engine
 
 
 class Team(SQLModel, table=True):
@@ -17,200 +32,231 @@ class Hero(SQLModel, table=True):
     secret_name: str
     age: Optional[int] = Field(default=None, index=True)
 
-    team_id: Optional[int] = Field(default=None, foreign_key="team.id")
+    team_id: Optional[int] = Field(default=None, foreign_key="team.id", index=True)
     team: Optional[Team] = Relationship(back_populates="heroes")
 
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
-
-engine = create_engine(sqlite_url, echo=False)
-
-
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+# rows fetched per batch when streaming large results
+YIELD_PER = 1000
 
 
-def create_heroes():
-    with Session(engine) as session:
-        team_preventers = Team(name="Preventers", headquarters="Sharp Tower")
-        team_z_force = Team(name="Z-Force", headquarters="Sister Margaret’s Bar")
+def print_lines(lines: Iterable[str]):
+    """Write lines to stdout in chunks of YIELD_PER, one write call per chunk"""
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) == YIELD_PER:
+            sys.stdout.write("\n".join(buffer) + "\n")
+            buffer.clear()
+    if buffer:
+        sys.stdout.write("\n".join(buffer) + "\n")
 
-        hero_deadpond = Hero(
-            name="Deadpond", secret_name="Dive Wilson", team=team_z_force
-        )
-        hero_rusty_man = Hero(
-            name="Rusty-Man", secret_name="Tommy Sharp", age=48, team=team_preventers
-        )
-        hero_spider_boy = Hero(name="Spider-Boy", secret_name="Pedro Parqueador")
-        session.add(hero_deadpond)
-        session.add(hero_rusty_man)
-        session.add(hero_spider_boy)
-        session.commit()
 
-        session.refresh(hero_deadpond)
-        session.refresh(hero_rusty_man)
-        session.refresh(hero_spider_boy)
+def format_row(row: Mapping[str, Any]) -> str:
+    """Format a row mapping in the field=value layout of the model repr"""
+    return " ".join(f"{key}={value!r}" for key, value in row.items())
 
-        print("Created hero:", hero_deadpond)
-        print("Created hero:", hero_rusty_man)
-        print("Created hero:", hero_spider_boy)
 
-        hero_spider_boy.team = team_preventers
-        session.add(hero_spider_boy)
-        session.commit()
-        session.refresh(hero_spider_boy)
-        print("Updated hero:", hero_spider_boy)
-
-        hero_black_lion = Hero(name="Black Lion", secret_name="Trevor Challa", age=35)
-        hero_sure_e = Hero(name="Princess Sure-E", secret_name="Sure-E")
-        team_wakaland = Team(
-            name="Wakaland",
-            headquarters="Wakaland Capital City",
-            heroes=[hero_black_lion, hero_sure_e],
-        )
-        session.add(team_wakaland)
-        session.commit()
-        session.refresh(team_wakaland)
-        print("Team Wakaland:", team_wakaland)
-
-        hero_tarantula = Hero(name="Tarantula", secret_name="Natalia Roman-on", age=32)
-        hero_dr_weird = Hero(name="Dr. Weird", secret_name="Steve Weird", age=36)
-        hero_cap = Hero(
-            name="Captain North America", secret_name="Esteban Rogelios", age=93
-        )
-
-        team_preventers.heroes.append(hero_tarantula)
-        team_preventers.heroes.append(hero_dr_weird)
-        team_preventers.heroes.append(hero_cap)
-        session.add(team_preventers)
-        session.commit()
-        session.refresh(hero_tarantula)
-        session.refresh(hero_dr_weird)
-        session.refresh(hero_cap)
-        print("Preventers new hero:", hero_tarantula)
-        print("Preventers new hero:", hero_dr_weird)
-        print("Preventers new hero:", hero_cap)
+def format_hero(hero: Hero) -> str:
+    """Format the hero columns only, leaving out loaded relationships"""
+    return format_row(
+        {column.key: getattr(hero, column.key) for column in Hero.__table__.c}
+    )
 
 
-def select_heroes():
-    """Select all Heroes"""
-    with Session(engine) as session:
-        heroes = session.exec(select(Hero)).all()
-        print(heroes)
+# stored in PRAGMA user_version once the tables and their indexes exist,
+# bump it when models change
+SCHEMA_VERSION = 1
 
 
-def select_hero_by_name(name: str):
-    """Select hero by name. Using 'one' instead of 'first'."""
-    with Session(engine) as session:
-        hero = session.exec(select(Hero).where(Hero.name == name)).one()
-        print(hero)
-
-
-def select_hero_by_id(id: int):
+def create_db_and_tables():
+    """Create the tables, unless user_version shows they are already there"""
+    with engine.begin() as connection:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        if version >= SCHEMA_VERSION:
+            return
+        SQLModel.metadata.create_all(connection)
+        # create_all skips the indexes of tables that already exist
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        connection.exec_driver_sql(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+def create_heroes(session: Session):
+    """Insert teams and heroes with one multi-row INSERT each, skipping the ORM"""
+    teams = [
+        {"name": "Z-Force", "headquarters": "Sister Margaret’s Bar"},
+        {"name": "Preventers", "headquarters": "Sharp Tower"},
+        {"name": "Wakaland", "headquarters": "Wakaland Capital City"},
+    ]
+    result = session.exec(insert(Team).values(teams))
+    # RETURNING on SQLite needs SQLAlchemy 2.0. The rows of a single INSERT get
+    # consecutive rowids, lastrowid is the last one, so the ids can be derived.
+    first_team_id = result.lastrowid - len(teams) + 1
+    team_ids = {team["name"]: first_team_id + i for i, team in enumerate(teams)}
+    for team_id, team in enumerate(teams, first_team_id):
+        print("Created team:", format_row({"id": team_id, **team}))
+
+    # Heroes go in with their final team, covering the step by step team changes
+    # of the ORM version. A multi-row INSERT needs the same keys on every row.
+    hero_columns = ("name", "secret_name", "age", "team_id")
+    heroes = [
+        dict(zip(hero_columns, values))
+        for values in [
+            ("Deadpond", "Dive Wilson", None, team_ids["Z-Force"]),
+            ("Rusty-Man", "Tommy Sharp", 48, team_ids["Preventers"]),
+            ("Spider-Boy", "Pedro Parqueador", None, team_ids["Preventers"]),
+            ("Black Lion", "Trevor Challa", 35, team_ids["Wakaland"]),
+            ("Princess Sure-E", "Sure-E", None, team_ids["Wakaland"]),
+            ("Tarantula", "Natalia Roman-on", 32, team_ids["Preventers"]),
+            ("Dr. Weird", "Steve Weird", 36, team_ids["Preventers"]),
+            ("Captain North America", "Esteban Rogelios", 93, team_ids["Preventers"]),
+        ]
+    ]
+    result = session.exec(insert(Hero).values(heroes))
+    first_hero_id = result.lastrowid - len(heroes) + 1
+    for hero_id, hero in enumerate(heroes, first_hero_id):
+        print("Created hero:", format_row({"id": hero_id, **hero}))
+
+
+def select_heroes(session: Session):
+    """Select all Heroes. Only the columns, no Hero objects are built.
+
+    Rows are streamed in batches of YIELD_PER, don't keep references to them
+    after they are printed.
+    """
+    statement = select(
+        Hero.id, Hero.name, Hero.secret_name, Hero.age, Hero.team_id
+    ).execution_options(yield_per=YIELD_PER)
+    print_lines(format_row(hero._mapping) for hero in session.exec(statement))
+
+
+def count_heroes(session: Session):
+    """Count Heroes without loading any of them"""
+    count = session.exec(select(func.count()).select_from(Hero)).one()
+    print(f"Heroes: {count}")
+
+
+def select_hero_by_name(session: Session, name: str):
+    """Select hero by name. Using 'one' instead of 'first'. Only the columns."""
+    statement = lambda_stmt(
+        lambda: select(
+            Hero.id, Hero.name, Hero.secret_name, Hero.age, Hero.team_id
+        ).where(Hero.name == name)
+    )
+    hero = session.execute(statement).one()
+    print(format_row(hero._mapping))
+
+
+def select_hero_by_id(session: Session, id: int):
     """Select Hero by Id. Using 'get' instead of 'exec'."""
-    with Session(engine) as session:
-        hero = session.get(Hero, id)
-        print(hero)
-
-
-def select_heroes_by_age_range(ge: int, lt: int):
-    """Select heroes in the age range"""
-    with Session(engine) as session:
-        heroes = session.exec(select(Hero).where(Hero.age >= ge, Hero.age < lt)).all()
-        print(heroes)
-
-
-def select_heroes_by_out_age_range(le: int, gt: int):
-    """Select heroes out of the selected age range"""
-    with Session(engine) as session:
-        heroes = session.exec(
-            select(Hero).where(or_(Hero.age <= le, Hero.age > gt))
-        ).all()
-        print(heroes)
+    hero = session.get(Hero, id)
+    print(hero)
+
+
+def select_heroes_by_age_range(session: Session, ge: int, lt: int):
+    """Select heroes in the age range. secret_name is only loaded if accessed."""
+    statement = lambda_stmt(
+        lambda: select(Hero)
+        .options(defer(Hero.secret_name))
+        .where(Hero.age >= ge, Hero.age < lt)
+    )
+    heroes = session.execute(statement).scalars().all()
+    print(heroes)
+
+
+def select_heroes_by_out_age_range(session: Session, le: int, gt: int):
+    """Select heroes out of the selected age range.
+
+    Each side of the range is a separate index range scan joined with UNION ALL.
+    The upper side starts above both limits so no hero is returned twice.
+    The union leaves out secret_name, it is only loaded if accessed.
+    """
+    above = max(le, gt)
+    # every column but secret_name, so a new Hero column isn't lazy loaded per hero
+    columns = [column for column in Hero.__table__.c if column.key != "secret_name"]
+    statement = lambda_stmt(
+        lambda: select(Hero)
+        .options(defer(Hero.secret_name))
+        .from_statement(
+            union_all(
+                select(*columns).where(Hero.age <= le),
+                select(*columns).where(Hero.age > above),
+            )
+        )
+    )
+    heroes = session.execute(statement).scalars().all()
+    print(heroes)
 
 
-def update_hero_age(id: int, age: int):
+def update_hero_age(session: Session, id: int, age: int):
     """Select Hero by Id. Then updates age."""
-    with Session(engine) as session:
-        hero = session.get(Hero, id)
-        print(hero)
+    hero = session.get(Hero, id)
+    print(hero)
 
-        hero.age = age
+    hero.age = age
 
-        session.add(hero)
-        session.commit()
-        session.refresh(hero)
-        print(hero)
+    session.add(hero)
+    print(hero)
 
 
-def delete_hero(id: str):
+def delete_hero(session: Session, id: str):
     """Select Hero by Id. Then delete it."""
-    with Session(engine) as session:
-        hero = session.get(Hero, id)
+    hero = session.get(Hero, id)
+    if hero is None:
+        print(f"There's no hero with id: {id}")
+        return
 
-        session.delete(hero)  #
-        session.commit()  #
+    session.delete(hero)  #
 
-        hero = session.get(Hero, id)
-        if hero is None:  #
-            print(f"There's no hero with id: {id}")
+    # the delete guarantees the hero is gone, no need to select it again
+    print(f"There's no hero with id: {id}")
 
 
-def select_heroes_teams():
+def select_heroes_teams(session: Session):
     """Select only heroes in teams"""
-    with Session(engine) as session:
-        statement = select(Hero, Team).join(Team)
-        results = session.exec(statement)
-        for hero, team in results:
-            print("Hero:", hero, "Team:", team)
+    # the inner join already fetches the team columns, load them into hero.team
+    statement = select(Hero).join(Team).options(contains_eager(Hero.team))
+    heroes = session.exec(statement)
+    print_lines(f"Hero: {format_hero(hero)} Team: {hero.team}" for hero in heroes)
 
 
-def select_heroes_and_teams():
+def select_heroes_and_teams(session: Session):
     """Select all heroes and if they have, their team"""
-    with Session(engine) as session:
-        statement = select(Hero, Team).join(Team, isouter=True)
-        results = session.exec(statement)
-        for hero, team in results:
-            print("Hero:", hero, "Team:", team)
-
-
-def assign_hero_to_team(teamid: int, heroid: int):
-    """Seach hero by id, assign team id"""
-    with Session(engine) as session:
-        hero = session.get(Hero, heroid)
-        if hero:
-            hero.team_id = teamid
-            session.add(hero)
-            session.commit()
-            session.refresh(hero)
-
-
-def remove_hero_from_team(id: int):
-    """Seach hero by id, remove team id"""
-    with Session(engine) as session:
-        hero = session.get(Hero, id)
-        if hero:
-            hero.team_id = None
-            session.add(hero)
-            session.commit()
-            session.refresh(hero)
+    # teams are loaded with a second "WHERE team.id IN (...)" query
+    statement = select(Hero).options(selectinload(Hero.team))
+    heroes = session.exec(statement)
+    print_lines(f"Hero: {format_hero(hero)} Team: {hero.team}" for hero in heroes)
+
+
+def assign_hero_to_team(session: Session, teamid: int, heroid: int):
+    """Assign team id to the hero in a single UPDATE, without loading it"""
+    session.exec(update(Hero).where(Hero.id == heroid).values(team_id=teamid))
+
+
+def remove_hero_from_team(session: Session, id: int):
+    """Remove the hero team id in a single UPDATE, without loading it"""
+    session.exec(update(Hero).where(Hero.id == id).values(team_id=None))
 
 
 def main():
     create_db_and_tables()
-    create_heroes()
-    # select_heroes()
-    # select_hero_by_name("Deadpond")
-    # select_hero_by_id(6)
-    # select_heroes_by_age_range(35, 45)
-    # select_heroes_by_out_age_range(35, 90)
-    # update_hero_age(id=2, age=16)
-    # delete_hero(5)
-    # select_heroes_teams()
-    # assign_hero_to_team(2, 7)
-    # remove_hero_from_team(1)
-    # select_heroes_and_teams()
+    with SessionLocal() as session:
+        create_heroes(session)
+        # count_heroes(session)
+        # select_hero_by_name(session, "Deadpond")
+        # select_hero_by_id(session, 6)
+        # select_heroes_by_age_range(session, 35, 45)
+        # select_heroes_by_out_age_range(session, 35, 90)
+        # update_hero_age(session, id=2, age=16)
+        # delete_hero(session, 5)
+        # select_heroes_teams(session)
+        # assign_hero_to_team(session, 2, 7)
+        # remove_hero_from_team(session, 1)
+        # select_heroes_and_teams(session)
+        # helpers don't commit, everything above is a single transaction
+        session.commit()
 
 
 if __name__ == "__main__":